@@ -1,7 +1,6 @@
 import os
 import argparse
 from pathlib import Path
-import time
 import json
 import numpy as np
 import pandas as pd
@@ -11,10 +10,11 @@ from processing import utils
 from processing import resmaps
 from processing.preprocessing import Preprocessor
 from processing.preprocessing import get_preprocessing_function
-from processing.resmaps import label_images
+from processing.resmaps import label_images, close_images
 from processing.utils import printProgressBar
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import confusion_matrix
+from joblib import Parallel, delayed
 from test import predict_classes
 import logging
 
@@ -23,42 +23,62 @@ logger = logging.getLogger(__name__)
 
 FINETUNE_SPLIT = 0.2
 STEP_MIN_AREA = 5  # 5
+# number of thresholds processed in parallel; each job labels the whole
+# validation batch (int32 labels and lookup arrays), so memory grows with N_JOBS
+N_JOBS = 4
 
 
-def determine_threshold(resmaps, min_area, thresh_min, thresh_max, thresh_step):
-    # set initial threshold, counter and max number of steps
-    n_steps = (thresh_max - thresh_min) // thresh_step + 1
-    thresholds = np.arange(
-        start=thresh_min, stop=thresh_max + thresh_step, step=thresh_step
-    )
+def get_largest_area(resmaps, threshold):
+    # segment (threshold) closed residual maps
+    resmaps_th = resmaps > threshold
 
-    # initialize progress bar
-    printProgressBar(0, n_steps, prefix="Progress:", suffix="Complete", length=50)
+    # compute labeled connected components
+    _, areas_all = label_images(resmaps_th)
 
-    for index, threshold in enumerate(thresholds):
-        # segment (threshold) residual maps
-        resmaps_th = resmaps > threshold
+    # return area of largest anomalous region
+    return np.amax(np.concatenate(areas_all))
 
-        # compute labeled connected components
-        _, areas_all = label_images(resmaps_th)
 
-        # check if area of largest anomalous region is below the minimum area
-        areas_all_flat = [item for sublist in areas_all for item in sublist]
-        largest_area = np.amax(np.array(areas_all_flat))
+def get_largest_areas(resmaps, thresholds):
+    """
+    Computes, for every threshold, the area of the largest anomalous region
+    found in the residual maps. This does not depend on min_area, so it is
+    computed once and shared by all min_area values of the finetuning loop.
+    Thresholds are independent of each other and are processed in parallel.
+    """
+    # close residual maps once, before thresholding
+    resmaps_closed = close_images(resmaps)
 
-        if min_area > largest_area:
-            time.sleep(0.1)
+    # initialize progress bar
+    n_steps = len(thresholds)
+    printProgressBar(0, n_steps, prefix="Progress:", suffix="Complete", length=50)
+
+    largest_areas = []
+    with Parallel(n_jobs=N_JOBS) as parallel:
+        for start in range(0, n_steps, N_JOBS):
+            largest_areas.extend(
+                parallel(
+                    delayed(get_largest_area)(resmaps_closed, threshold)
+                    for threshold in thresholds[start : start + N_JOBS]
+                )
+            )
+            # print progress bar
             printProgressBar(
-                n_steps, n_steps, prefix="Progress:", suffix="Complete", length=50
+                len(largest_areas),
+                n_steps,
+                prefix="Progress:",
+                suffix="Complete",
+                length=50,
             )
-            break
+    return np.array(largest_areas)
 
-        # print progress bar
-        time.sleep(0.1)
-        printProgressBar(
-            index, n_steps, prefix="Progress:", suffix="Complete", length=50
-        )
-    return threshold
+
+def determine_threshold(thresholds, largest_areas, min_area):
+    # select first threshold for which the largest anomalous region is below min_area
+    indices = np.flatnonzero(largest_areas < min_area)
+    if indices.size > 0:
+        return thresholds[indices[0]]
+    return thresholds[-1]
 
 
 def main(args):
@@ -208,20 +228,31 @@ def main(args):
     min_areas = np.arange(start=5, stop=505, step=STEP_MIN_AREA)
     length = len(min_areas)
 
+    # compute largest anomalous region on validation resmaps for each threshold
+    thresholds = np.arange(
+        start=tensor_val.thresh_min,
+        stop=tensor_val.thresh_max + tensor_val.thresh_step,
+        step=tensor_val.thresh_step,
+    )
+    logger.info("computing largest anomalous areas for each threshold...")
+    largest_areas = get_largest_areas(resmaps=tensor_val.resmaps, thresholds=thresholds)
+
+    # close finetuning resmaps once, before thresholding
+    resmaps_ft_closed = close_images(tensor_ft.resmaps)
+
     for i, min_area in enumerate(min_areas):
         print("step {}/{} | current min_area = {}".format(i + 1, length, min_area))
         # compute threshold corresponding to current min_area
         threshold = determine_threshold(
-            resmaps=tensor_val.resmaps,
-            min_area=min_area,
-            thresh_min=tensor_val.thresh_min,
-            thresh_max=tensor_val.thresh_max,
-            thresh_step=tensor_val.thresh_step,
+            thresholds=thresholds, largest_areas=largest_areas, min_area=min_area,
         )
 
         # apply the min_area, threshold pair to finetuning images
         y_ft_pred = predict_classes(
-            resmaps=tensor_ft.resmaps, min_area=min_area, threshold=threshold
+            resmaps=resmaps_ft_closed,
+            min_area=min_area,
+            threshold=threshold,
+            closed=True,
         )
 
         # confusion matrix
@@ -290,7 +321,9 @@ def plot_min_area_threshold(dict_finetune, index_best=None, save_dir=None):
     min_areas = dict_finetune["min_area"]
     thresholds = dict_finetune["threshold"]
     with plt.style.context("seaborn-darkgrid"):
-        df_finetune.plot(x="min_area", y=["threshold"], figsize=(12, 8))
+        fig = df_finetune.plot(
+            x="min_area", y=["threshold"], figsize=(12, 8)
+        ).get_figure()
         if index_best is not None:
             x = dict_finetune["min_area"][index_best]
             y = dict_finetune["threshold"][index_best]
@@ -302,29 +335,33 @@ def plot_min_area_threshold(dict_finetune, index_best=None, save_dir=None):
             x, y
         )
         plt.title(title)
-        plt.show()
+        if save_dir is None:
+            plt.show()
     if save_dir is not None:
-        plt.savefig(os.path.join(save_dir, "min_area_threshold_plot.png"))
+        fig.savefig(os.path.join(save_dir, "min_area_threshold_plot.png"))
         print("min_area threshold plot successfully saved at:\n {}".format(save_dir))
-        plt.close()
+        plt.close(fig=fig)
     return
 
 
 def plot_scores(dict_finetune, index_best=None, save_dir=None):
     df_finetune = pd.DataFrame.from_dict(dict_finetune)
     with plt.style.context("seaborn-darkgrid"):
-        df_finetune.plot(x="min_area", y=["TPR", "TNR", "score"], figsize=(12, 8))
+        fig = df_finetune.plot(
+            x="min_area", y=["TPR", "TNR", "score"], figsize=(12, 8)
+        ).get_figure()
         if index_best is not None:
             x = dict_finetune["min_area"][index_best]
             y = dict_finetune["score"][index_best]
             plt.axvline(x, 0, 1, linestyle="dashed", color="red", linewidth=0.5)
             plt.plot(x, y, markersize=10, marker="o", color="red", label="best score")
         plt.title(f"Scores plot\nbest score = {y:.2E}")
-        plt.show()
+        if save_dir is None:
+            plt.show()
     if save_dir is not None:
-        plt.savefig(os.path.join(save_dir, "scores_plot.png"))
+        fig.savefig(os.path.join(save_dir, "scores_plot.png"))
         print("scores plot successfully saved at:\n {}".format(save_dir))
-        plt.close()
+        plt.close(fig=fig)
     return
 
 
@@ -1,14 +1,10 @@
 import os
-import time
 import numpy as np
+from scipy import ndimage as ndi
 from skimage.metrics import structural_similarity as ssim
 from processing import utils
 from processing.utils import printProgressBar as printProgressBar
 import matplotlib.pyplot as plt
-from skimage.util import img_as_ubyte
-from skimage.segmentation import clear_border
-from skimage.measure import label, regionprops
-from skimage.morphology import closing, square
 from skimage.color import label2rgb
 import cv2
 import logging
@@ -84,8 +80,6 @@ class TensorImages:
                 self.thresh_step = THRESH_STEP_UINT8_L2
                 self.vmin_resmap = 0
                 self.vmax_resmap = 255
-            # Convert to 8-bit unsigned int
-            self.resmaps = img_as_ubyte(self.resmaps)
 
         # compute maximal threshold based on resmaps
         self.thresh_max = np.amax(self.resmaps)
@@ -100,7 +94,6 @@ class TensorImages:
         for i in range(len(self.imgs_input)):
             self.plot_input_pred_resmap(index=i, group=group, save_dir=save_dir)
             # print progress bar
-            time.sleep(0.1)
             printProgressBar(i + 1, l, prefix="Progress:", suffix="Complete", length=50)
         if save_dir is not None:
             logger.info("all generated files are saved at: \n{}".format(save_dir))
@@ -191,10 +184,39 @@ def calculate_resmaps(imgs_input, imgs_pred, method, dtype="float64"):
     elif method in ["ssim", "mssim"]:
         resmaps = resmaps_ssim(imgs_input, imgs_pred)
     if dtype == "uint8":
-        resmaps = img_as_ubyte(resmaps)
+        resmaps = _resmaps_to_uint8(resmaps)
     return resmaps
 
 
+def _resmaps_to_uint8(resmaps):
+    """
+    Converts float residual maps to 8-bit unsigned integers, like
+    skimage's img_as_ubyte (values in [-1, 1], negative values map to 0).
+    The float residual maps are scaled in place to avoid allocating a
+    float temporary of the size of the batch, i.e. the input is
+    overwritten. Only meant for freshly computed resmaps in
+    calculate_resmaps.
+
+    Parameters
+    ----------
+    resmaps : array of float
+        Residual maps with values in [-1, 1].
+
+    Returns
+    -------
+    resmaps_uint8 : array of uint8
+        Converted residual maps.
+
+    """
+    if resmaps.min() < -1.0 or resmaps.max() > 1.0:
+        raise ValueError("Images of type float must be between -1 and 1.")
+    np.multiply(resmaps, 255, out=resmaps)
+    np.rint(resmaps, out=resmaps)
+    np.clip(resmaps, 0, 255, out=resmaps)
+    resmaps_uint8 = resmaps.astype("uint8")
+    return resmaps_uint8
+
+
 def resmaps_ssim(imgs_input, imgs_pred):
     resmaps = np.zeros(shape=imgs_input.shape, dtype="float64")
     for index in range(len(imgs_input)):
@@ -208,9 +230,9 @@ def resmaps_ssim(imgs_input, imgs_pred):
             sigma=1.5,
             full=True,
         )
-        # resmap = np.expand_dims(resmap, axis=-1)
-        resmaps[index] = 1 - resmap
-    resmaps = np.clip(resmaps, a_min=-1, a_max=1)
+        # compute resmap in place into the preallocated batch
+        np.subtract(1, resmap, out=resmaps[index])
+    np.clip(resmaps, a_min=-1, a_max=1, out=resmaps)
     return resmaps
 
 
@@ -222,52 +244,100 @@ def resmaps_l2(imgs_input, imgs_pred):
 ## functions for processing resmaps
 
 
-def label_images(images_th):
+def close_images(images, kernel_size=3):
     """
-    Segments images into images of connected components (regions).
-    Returns segmented images and a list of lists, whereby each list 
-    contains the areas of the regions of the corresponding image. 
-    
+    Performs morphological closing on each image (closes small holes).
+    Closing commutes with thresholding: thresholding closed residual maps
+    gives the same result as closing thresholded residual maps, so the
+    residual maps can be closed once and then thresholded many times.
+
     Parameters
     ----------
-    images_th : array of uint8
-        Thresholded residual maps.
+    images : array
+        Residual maps, of shape (N, H, W).
     kernel_size : int, optional
-        Size of the kernel window. The default is 3.
+        Size of the square kernel window. The default is 3.
 
     Returns
     -------
-    images_labeled : array of uint8
-        Labeled images.
-    areas_all : list of lists
-        List of lists, whereby each list contains the areas of the regions of the corresponding image.
+    images_closed : array
+        Closed images.
 
     """
-    images_labeled = np.zeros(shape=images_th.shape)
-    areas_all = []
-    for i, image_th in enumerate(images_th):
-        # close small holes with binary closing
-        bw = closing(image_th, square(3))
-
-        # remove artifacts connected to image border
-        cleared = clear_border(bw)
-
-        # label image regions
-        image_labeled = label(cleared)
+    footprint = np.ones((1, kernel_size, kernel_size))
+    images_closed = ndi.grey_closing(images, footprint=footprint)
+    return images_closed
 
-        # image_labeled = label(image_th)
 
-        # append image
-        images_labeled[i] = image_labeled
+def label_images(images_th):
+    """
+    Segments images into images of connected components (regions).
+    Returns segmented images and a list of arrays, whereby each array 
+    contains the areas of the regions of the corresponding image. 
+    The whole batch is labeled at once, with 8-connectivity within each
+    image and no connectivity across images.
+    
+    Parameters
+    ----------
+    images_th : array of bool
+        Thresholded residual maps, of shape (N, H, W). Residual maps should
+        be closed with close_images before thresholding.
 
-        # compute areas of anomalous regions in the current image
-        regions = regionprops(image_labeled)
+    Returns
+    -------
+    images_labeled : array of int32
+        Labeled images, labels start at 1 in each image.
+    areas_all : list of arrays
+        List of arrays, whereby each array contains the areas of the regions of the corresponding image.
 
-        if regions:
-            areas = [region.area for region in regions]
-            areas_all.append(areas)
-        else:
-            areas_all.append([0])
+    """
+    nb_images = len(images_th)
+
+    # label image regions of all images in one pass
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = True
+    images_labeled = np.empty(images_th.shape, dtype=np.int32)
+    nb_labels = ndi.label(images_th, structure=structure, output=images_labeled)
+
+    # find regions connected to image border (and background label 0)
+    border_labels = np.concatenate(
+        [
+            images_labeled[:, 0, :].ravel(),
+            images_labeled[:, -1, :].ravel(),
+            images_labeled[:, :, 0].ravel(),
+            images_labeled[:, :, -1].ravel(),
+        ]
+    )
+    is_removed = np.zeros(nb_labels + 1, dtype=bool)
+    is_removed[border_labels] = True
+    is_removed[0] = True
+
+    # find image index of each region
+    image_indices = np.zeros(nb_labels + 1, dtype=np.intp)
+    image_indices[images_labeled.reshape(nb_images, -1)] = np.arange(nb_images)[
+        :, np.newaxis
+    ]
+
+    # compute areas of remaining regions, grouped by image
+    labels_kept = np.flatnonzero(~is_removed)
+    areas_kept = np.bincount(images_labeled.ravel(), minlength=nb_labels + 1)[
+        labels_kept
+    ]
+    order = np.argsort(image_indices[labels_kept], kind="stable")
+    labels_kept = labels_kept[order]
+    areas_kept = areas_kept[order]
+    nb_regions = np.bincount(image_indices[labels_kept], minlength=nb_images)
+    offsets = np.cumsum(nb_regions) - nb_regions
+
+    # remove border regions and relabel regions starting at 1 in each image
+    lookup = np.zeros(nb_labels + 1, dtype=images_labeled.dtype)
+    lookup[labels_kept] = (
+        np.arange(labels_kept.size) - np.repeat(offsets, nb_regions) + 1
+    )
+    images_labeled = lookup[images_labeled]
+
+    areas_all = np.split(areas_kept, offsets[1:])
+    areas_all = [areas if areas.size > 0 else np.array([0]) for areas in areas_all]
 
     return images_labeled, areas_all
 
@@ -291,21 +361,20 @@ def equalize_images(images):
         Equalized images.
 
     """
-    images_equalized = np.zeros(shape=images.shape, dtype="uint8")
+    images_equalized = np.empty(shape=images.shape, dtype="uint8")
     for i, image in enumerate(images):
         image_equalized = cv2.equalizeHist(image)
-        image_equalized = np.expand_dims(image_equalized, axis=-1)
-        images_equalized[i] = image_equalized
+        # OpenCV drops a trailing channel axis, reshape is a view
+        images_equalized[i] = image_equalized.reshape(image.shape)
     return images_equalized
 
 
 def filter_gauss_images(images, kernel_size=5):
-    images_filtered = np.zeros(shape=images.shape, dtype="uint8")
+    images_filtered = np.empty(shape=images.shape, dtype="uint8")
     kernel = (kernel_size, kernel_size)
     for i, image in enumerate(images):
         image_filtered = cv2.GaussianBlur(image, kernel, 0)
-        image_filtered = np.expand_dims(image_filtered, axis=-1)
-        images_filtered[i] = image_filtered
+        images_filtered[i] = image_filtered.reshape(image.shape)
     return images_filtered
 
 
@@ -327,10 +396,8 @@ def filter_median_images(images, kernel_size=3):
         Filtered images.
 
     """
-    images_filtered = np.zeros(shape=images.shape, dtype="uint8")
+    images_filtered = np.empty(shape=images.shape, dtype="uint8")
     for i, image in enumerate(images):
         image_filtered = cv2.medianBlur(image, kernel_size)
-        image_filtered = np.expand_dims(image_filtered, axis=-1)
-        images_filtered[i] = image_filtered
+        images_filtered[i] = image_filtered.reshape(image.shape)
     return images_filtered
-
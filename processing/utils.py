@@ -72,7 +72,7 @@ def load_model_HDF5(model_path):
 
 def save_np(arr, save_dir, filename):
     np.save(
-        file=os.path.join(save_dir, filename), arr=arr, allow_pickle=True,
+        file=os.path.join(save_dir, filename), arr=arr, allow_pickle=False,
     )
 
 
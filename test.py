@@ -9,7 +9,7 @@ from processing import utils
 from processing import resmaps
 from processing.preprocessing import Preprocessor
 from processing.preprocessing import get_preprocessing_function
-from processing.resmaps import label_images
+from processing.resmaps import label_images, close_images
 from processing.utils import printProgressBar
 from skimage.util import img_as_ubyte
 from sklearn.metrics import confusion_matrix
@@ -21,28 +21,63 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = 32  # batch size for predicting on test images
+
 
 def get_true_classes(filenames):
-    # retrieve ground truth
-    y_true = [1 if "good" not in filename.split("/") else 0 for filename in filenames]
+    # retrieve ground truth (defective unless a "good" directory is in the path)
+    filenames = np.char.add(np.char.add("/", np.asarray(filenames)), "/")
+    y_true = (np.char.find(filenames, "/good/") == -1).astype(int)
     return y_true
 
 
-def is_defective(areas, min_area):
-    """Decides if image is defective given the areas of its connected components"""
-    areas = np.array(areas)
-    if areas[areas >= min_area].shape[0] > 0:
-        return 1
-    return 0
+def predict_images(model, generator, color_mode):
+    """
+    Reconstructs the images of the generator batch by batch and returns the
+    grayscale input and reconstructed images, without channel axis.
+    The generator output is never materialized as a single batch, but the
+    returned grayscale arrays cover the whole set of images.
+    """
+    nb_images = generator.samples
+    shape = (nb_images,) + tuple(generator.image_shape[:2])
+    imgs_input = np.empty(shape=shape, dtype="float32")
+    imgs_pred = np.empty(shape=shape, dtype="float32")
+    for i in range(len(generator)):
+        batch_input = generator[i][0]
+        batch_pred = np.asarray(model.predict_on_batch(batch_input))
 
+        # convert to grayscale if RGB
+        if color_mode == "rgb":
+            batch_input = tf.image.rgb_to_grayscale(batch_input).numpy()
+            batch_pred = tf.image.rgb_to_grayscale(batch_pred).numpy()
 
-def predict_classes(resmaps, min_area, threshold):
+        # remove last channel since images are grayscale
+        start = i * generator.batch_size
+        stop = start + len(batch_input)
+        imgs_input[start:stop] = batch_input[:, :, :, 0]
+        imgs_pred[start:stop] = batch_pred[:, :, :, 0]
+    return imgs_input, imgs_pred
+
+
+def predict_classes(resmaps, min_area, threshold, closed=False):
+    # close residual maps, unless already closed with close_images
+    if not closed:
+        resmaps = close_images(resmaps)
     # threshold residual maps with the given threshold
     resmaps_th = resmaps > threshold
-    # compute connected components
-    _, areas_all = label_images(resmaps_th)
-    # Decides if images are defective given the areas of their connected components
-    y_pred = [is_defective(areas, min_area) for areas in areas_all]
+    # images with less anomalous pixels than min_area can not be defective
+    nb_pixels = np.count_nonzero(resmaps_th.reshape(len(resmaps_th), -1), axis=1)
+    candidates = np.flatnonzero(nb_pixels >= min_area)
+    y_pred = np.zeros(len(resmaps_th), dtype=int)
+    if candidates.size == 0:
+        return y_pred
+    # compute connected components of remaining images
+    _, areas_all = label_images(resmaps_th[candidates])
+    # Decides if images are defective given the area of their largest connected component
+    nb_areas = np.fromiter(map(len, areas_all), dtype=np.intp, count=len(areas_all))
+    offsets = np.cumsum(nb_areas) - nb_areas
+    largest_areas = np.maximum.reduceat(np.concatenate(areas_all), offsets)
+    y_pred[candidates] = largest_areas >= min_area
     return y_pred
 
 
@@ -129,28 +164,17 @@ def main(args):
         )
 
         # get test generator
-        nb_test_images = preprocessor.get_total_number_test_images()
         test_generator = preprocessor.get_test_generator(
-            batch_size=nb_test_images, shuffle=False
+            batch_size=BATCH_SIZE, shuffle=False
         )
 
-        # retrieve test images from generator
-        imgs_test_input = test_generator.next()[0]
-
         # retrieve test image names
         filenames = test_generator.filenames
 
-        # predict on test images
-        imgs_test_pred = model.predict(imgs_test_input)
-
-        # convert to grayscale if RGB
-        if color_mode == "rgb":
-            imgs_test_input = tf.image.rgb_to_grayscale(imgs_val_input).numpy()
-            imgs_test_pred = tf.image.rgb_to_grayscale(imgs_val_pred).numpy()
-
-        # remove last channel since images are grayscale
-        imgs_test_input = imgs_test_input[:, :, :, 0]
-        imgs_test_pred = imgs_test_pred[:, :, :, 0]
+        # predict on test images (grayscale, without channel axis)
+        imgs_test_input, imgs_test_pred = predict_images(
+            model, test_generator, color_mode
+        )
 
         # instantiate TensorImages object
         tensor_test = resmaps.TensorImages(
@@ -213,7 +237,7 @@ def main(args):
             "filenames": filenames,
             "predictions": y_pred,
             "truth": y_true,
-            "accurate_predictions": np.array(y_true) == np.array(y_pred),
+            "accurate_predictions": y_true == y_pred,
         }
         df_clf = pd.DataFrame.from_dict(classification)
         with open(os.path.join(save_dir, "classification.txt"), "w") as f: